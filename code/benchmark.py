@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+r'''Benchmarks for the perception hot paths.
+
+    Times snapshot conversion, Bayer mosaicking, correlation, template search,
+    'where' contour election and full visual map lookups over synthetic scenes
+    from 720p to 4K, and prints the results as JSON. Given the results of an
+    earlier run as a baseline, also reports how each timing changed, and exits
+    with an error status if any got slower than the given tolerance.
+
+    Examples:
+
+        python benchmark.py --output baseline.json
+        python benchmark.py --baseline baseline.json --tolerance 0.2
+'''
+
+__license__ = r'''
+Copyright (c) Helio Perroni Filho <xperroni@gmail.com>
+
+This file is part of Skeye.
+
+Skeye is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Skeye is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Skeye. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__version__ = '1'
+
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from time import time
+
+import numpy
+from numpy.random import RandomState
+from scipy.misc import toimage
+
+from skeye import bayer, correlate, fourier, snapshot, templatesearch
+from skeye.cogs import descript, percept, visualmap, what, where
+
+
+scenes = {
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '1440p': (1440, 2560),
+    '4K': (2160, 3840)
+}
+
+templates = {
+    'small': (24, 32),
+    'large': (96, 160)
+}
+
+
+def timeit(function, repeat):
+    r'''Runs the function once to warm up any caches, then repeat times more,
+        returning the best and mean running times, in seconds.
+    '''
+    function()
+    times = []
+    for i in range(repeat):
+        start = time()
+        function()
+        times.append(time() - start)
+
+    return (min(times), sum(times) / len(times))
+
+
+def synthesize(shape, size, random):
+    r'''Returns a synthetic RGB scene of the given shape, a grid of button-like
+        contours covering it, and the contour in which a template of the given
+        size is placed.
+    '''
+    (m, n) = shape
+    image = random.randint(0, 256, (m // 8, n // 8, 3)).astype(numpy.uint8)
+    image = image.repeat(8, axis=0).repeat(8, axis=1)
+
+    (h, w) = (size[0] + 16, size[1] + 16)
+    contours = tuple(
+        ((r, r + h), (c, c + w))
+        for r in range(0, m - h, h + 4)
+        for c in range(0, n - w, w + 4)
+    )
+
+    contour = contours[len(contours) // 2]
+    ((r0, rn), (c0, cn)) = contour
+    image[r0:rn, c0:cn] = random.randint(0, 256, (h, w, 3))
+    return (image, contours, contour)
+
+
+def cases(shape, size, random):
+    r'''Returns the list of (name, function) benchmark cases for a scene of the
+        given shape and a template of the given size.
+    '''
+    (image, contours, contour) = synthesize(shape, size, random)
+    pil = toimage(image)
+    mosaic = bayer(image)
+
+    ((r0, rn), (c0, cn)) = contour
+    roi = ((r0 + 8, r0 + 8 + size[0]), (c0 + 8, c0 + 8 + size[1]))
+    template = mosaic[r0 + 8:r0 + 8 + size[0], c0 + 8:c0 + 8 + size[1]]
+
+    memory = visualmap(mosaic, descript('target', what(*roi), where('buttons')), buttons=contours)
+    integrate = where('buttons')
+    spotted = percept(template, roi[0][0:1] + roi[1][0:1], percept(mosaic))
+    scene = percept(mosaic)
+
+    return [
+        ('snapshot', lambda: snapshot(pil)),
+        ('bayer', lambda: bayer(image)),
+        ('correlate', lambda: correlate(mosaic, template)),
+        ('templatesearch', lambda: templatesearch(mosaic, template)),
+        ('templatesearch-normalized', lambda: templatesearch(mosaic, template, True)),
+        ('templatesearch-pyramid', lambda: templatesearch(mosaic, template, False, 2)),
+        ('where', lambda: integrate(spotted, memory)),
+        ('visualmap', lambda: memory('target', scene))
+    ]
+
+
+def run(names, repeat):
+    r'''Runs the benchmarks over the named scene sizes, returning the list of
+        results.
+    '''
+    random = RandomState(0)
+    results = []
+    for name in names:
+        for (label, size) in sorted(templates.items()):
+            for (case, function) in cases(scenes[name], size, random):
+                (best, mean) = timeit(function, repeat)
+                results.append({
+                    'case': case,
+                    'scene': name,
+                    'template': label,
+                    'best': best,
+                    'mean': mean
+                })
+
+                print >> sys.stderr, '%-26s %-6s %-6s %10.6f' % (case, name, label, best)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    r'''Compares results against a baseline, printing the ratio between the
+        best timings of each case found in both. Returns the list of cases that
+        got slower than the tolerance allows.
+    '''
+    key = lambda result: (result['case'], result['scene'], result['template'])
+    previous = dict((key(result), result) for result in baseline['results'])
+
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before == None:
+            continue
+
+        ratio = result['best'] / before['best']
+        result['baseline'] = before['best']
+        result['ratio'] = ratio
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(result)
+            flag = ' REGRESSION'
+
+        print >> sys.stderr, '%-26s %-6s %-6s %10.6f -> %10.6f (%.2fx)%s' % (
+            key(result) + (before['best'], result['best'], ratio, flag)
+        )
+
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Benchmarks the perception hot paths.')
+    parser.add_argument('--scenes', default=','.join(sorted(scenes, key=lambda name: scenes[name])),
+        help='comma-separated scene sizes to run, among: %s' % ', '.join(sorted(scenes)))
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each case')
+    parser.add_argument('--fft', default='numpy', help='FFT library (see skeye.fourier)')
+    parser.add_argument('--output', help='file to write JSON results to, instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='largest slowdown relative to the baseline not reported as a regression')
+
+    args = parser.parse_args()
+    fourier.configure(args.fft)
+
+    results = run(args.scenes.split(','), args.repeat)
+    regressions = []
+    if args.baseline != None:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'fft': fourier.library,
+            'machine': platform.machine()
+        },
+        'results': results
+    }
+
+    output = open(args.output, 'w') if args.output != None else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if output is not sys.stdout:
+        output.close()
+
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+r'''Runs the X11 desktop automator against a stub xdotool, which just records
+    its arguments, and checks the command lines it was given.
+'''
+
+__license__ = r'''
+Copyright (c) Helio Perroni Filho <xperroni@gmail.com>
+
+This file is part of Skeye.
+
+Skeye is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Skeye is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Skeye. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__version__ = '1'
+
+from os import chmod
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from skeye.effectors import desktop
+
+
+stub = r'''#!/bin/sh
+for arg in "$@"; do printf '[%s]' "$arg"; done >> "$0.log"
+echo >> "$0.log"
+'''
+
+
+def main():
+    folder = mkdtemp()
+    try:
+        binary = join(folder, 'xdotool')
+        with open(binary, 'w') as file:
+            file.write(stub)
+
+        chmod(binary, 0755)
+        desktop.use('x11', binary)
+
+        desktop.click(10, 20)
+        desktop.write('-v it\'s "quoted"\nnext')
+        with desktop.batch():
+            desktop.click(30, 40)
+            desktop.write('field\t')
+            desktop.click(50, 60)
+
+        with open(binary + '.log') as file:
+            logged = file.read().splitlines()
+
+        expected = [
+            '[mousemove][10][20][sleep][0.1][click][1]',
+            '[type][--delay][12][--][-v it\'s "quoted"]',
+            '[key][--delay][12][KP_Enter][type][--delay][12][next]',
+            '[mousemove][30][40][sleep][0.1][click][1][type][--delay][12][field]',
+            '[key][--delay][12][Tab][mousemove][50][60][sleep][0.1][click][1]'
+        ]
+
+        for line in logged:
+            print line
+
+        print 'OK' if logged == expected else 'MISMATCH'
+    finally:
+        rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -43,17 +43,20 @@ along with Skeye. If not, see <http://www.gnu.org/licenses/>.
 
 __version__ = '1'
 
+from collections import Iterator, OrderedDict
 from itertools import izip
+from threading import RLock
+from weakref import ref
 
 from Image import open as loadimage
-from Image import ANTIALIAS
+from Image import fromarray, ANTIALIAS
 
-from numpy import dstack, indices, zeros, ndarray
-from numpy import argmax, conj, mean, vdot
-from numpy import where, logical_and, logical_xor
-from numpy.fft import rfft2, irfft2
+from numpy import dstack, empty, frombuffer, zeros, ndarray, uint8, where
+from numpy import arange, argmax, argsort, asarray, pad, clip, conj, inf, maximum, minimum, mean, sqrt, vdot
+from numpy import dtype as datatype, float64, complex64, result_type
 
 from scipy.misc import fromimage, toimage
+from scipy.ndimage import maximum_filter
 
 
 # Programming facilities
@@ -77,28 +80,43 @@ def singleton(cls):
     return cls()
 
 
-def snapshot(image=None, size=None):
+def snapshot(image=None, size=None, mode=None):
     r'''Acquires an image as a numpy array.
 
-        If the image argument is None, a screenshot is grabbed. otherwise, the
-        given image is converted to a 2- or 3-dimensional numpy array, depending
-        on whether it's colour or grayscale.
+        If the image argument is None, a screenshot is grabbed (see
+        skeye.capture). If it's a frame source (i.e. an iterator, see
+        skeye.sources), its next frame is taken, or a failure raised if it's
+        exhausted. otherwise, the given image is converted to a 2- or
+        3-dimensional numpy array, depending on whether it's colour or
+        grayscale.
+
+        The mode argument selects a different output: 'L' returns a single
+        channel (grayscale) array, and 'bayer' a Bayer mosaic (see bayer),
+        built straight from the image's pixel buffer.
+
+        Arrays converted from PIL images are mapped over a single copy of the
+        image's pixel buffer, and are therefore read-only.
     '''
+    if isinstance(image, Iterator):
+        image = next(image, None)
+        if image is None:
+            raise failure('Frame source exhausted')
+
+    if image is None:
+        from skeye.capture import screen
+        image = screen()
+        if isinstance(image, ndarray) and size != None:
+            image = fromarray(image)
+
     if isinstance(image, ndarray):
-        return image
-
-    if image == None:
-        try:
-            from ImageGrab import grab
-            image = grab()
-            image.save('screenshot.png')
-        except:
-            from os import system
-            name = 'screenshot.png'
-            command = "scrot %s" % name
-            system(command)
-            image = loadimage(name)
-    elif isinstance(image, basestring):
+        if mode == None or image.ndim == 2:
+            return image
+        elif mode == 'bayer':
+            return bayer(image)
+
+        image = fromarray(image)
+
+    if isinstance(image, basestring):
         image = loadimage(image)
         image.load()
 
@@ -106,7 +124,33 @@ def snapshot(image=None, size=None):
         (m, n) = size
         image = image.resize((n, m), ANTIALIAS)
 
-    return dstack(fromimage(channel) for channel in image.split())
+    if mode == 'L':
+        return _toarray(image.convert('L'))[:, :, 0]
+
+    data = _toarray(image)
+    if mode == 'bayer':
+        return bayer(data)
+
+    return data
+
+
+def _toarray(image):
+    r'''Maps the pixel buffer of a PIL image onto a 3-dimensional numpy array.
+        Palette and grey-with-alpha images are converted to colour first, as
+        scipy.misc.fromimage() does.
+    '''
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    elif image.mode == 'LA':
+        image = image.convert('RGBA')
+
+    if image.mode not in ('L', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr'):
+        return dstack([fromimage(channel) for channel in image.split()])
+
+    tobytes = getattr(image, 'tobytes', None) or image.tostring
+    (n, m) = image.size
+    data = frombuffer(tobytes(), dtype=uint8)
+    return data.reshape((m, n, len(image.getbands())))
 
 
 class ballot(object):
@@ -176,12 +220,84 @@ def crop(array, shape):
     return array[index]
 
 
+def decimate(image):
+    r'''Halves an image's resolution by averaging together each 2x2 block of
+        pixels. For Bayer mosaics, each block covers a whole colour cell.
+    '''
+    (m, n) = (image.shape[0] // 2 * 2, image.shape[1] // 2 * 2)
+    return (
+        image[0:m:2, 0:n:2].astype(float) + image[0:m:2, 1:n:2] +
+        image[1:m:2, 0:n:2] + image[1:m:2, 1:n:2]
+    ) / 4.0
+
+
+def fingerprint(image, step=8):
+    r'''Returns a cheap fingerprint of an image, for quickly telling whether
+        two images are (almost certainly) identical.
+
+        The image is split into blocks of step x step pixels, and each block is
+        summarized by the sum of its pixels, plus their first moments along
+        rows and columns -- so that changes to a block's contents are caught
+        even if they keep its sum (e.g. a glyph shifting within a block). The
+        summaries are hashed along with the image's shape. Changes that keep
+        all three values of every block, such as some pixel swaps, still go
+        unnoticed.
+    '''
+    (m, n) = image.shape[0:2]
+    (m, n) = (m // step * step, n // step * step)
+    blocks = image[:m, :n].reshape((m // step, step, n // step, step) + image.shape[2:])
+    channels = (1,) * (image.ndim - 2)
+    rows = blocks.sum(axis=3)
+    cols = blocks.sum(axis=1)
+    sample = (
+        rows.sum(axis=1),
+        (rows * arange(step).reshape((1, step, 1) + channels)).sum(axis=1),
+        (cols * arange(step).reshape((1, 1, step) + channels)).sum(axis=2)
+    )
+
+    tail = (image[m:].sum(), image[:m, n:].sum())
+    return (image.shape, hash(''.join(s.tostring() for s in sample)), tail)
+
+
+def integral(image):
+    r'''Returns the summed-area table of an image. The table has an extra
+        leading row and column of zeros, so that the sum over any rectangular
+        window can be computed from just four lookups.
+    '''
+    (m, n) = image.shape
+    table = zeros((m + 1, n + 1))
+    table[1:, 1:] = image.cumsum(0, dtype=float).cumsum(1)
+    return table
+
+
 def mag(x):
     r'''Returns the magnitude ("length") of a vector x.
     '''
     return vdot(x, x) ** 0.5
 
 
+def ncc(a, b):
+    r'''Returns the normalized cross-correlation between two arrays of the
+        same shape, i.e. the cosine of the angle between their mean-subtracted
+        values, as a real number between -1 and 1.
+    '''
+    a = a - mean(a)
+    b = b - mean(b)
+    return angle(a, b)
+
+
+def overlap(region, rectangles):
+    r'''Returns an array with the areas of overlap between a region ((r0, rn),
+        (c0, cn)) and each of a sequence of rectangles in the same format.
+        Ranges are half-open, i.e. rn and cn are not included.
+    '''
+    region = asarray(region)
+    rectangles = asarray(rectangles).reshape((-1,) + region.shape)
+    lower = maximum(rectangles[..., 0], region[:, 0])
+    upper = minimum(rectangles[..., 1], region[:, 1])
+    return clip(upper - lower, 0, None).prod(axis=-1)
+
+
 def searchmax(inputs):
     r'''Returns the coordinates of the highest value in a two-dimensional
         matrix.
@@ -191,71 +307,577 @@ def searchmax(inputs):
     return (i // n, i % n)
 
 
+def windowsum(table, shape):
+    r'''Given the summed-area table of an image, returns the sums over all
+        windows of the given shape that fit entirely within the image.
+    '''
+    (m, n) = shape
+    return table[m:, n:] - table[:-m, n:] - table[m:, :-n] + table[:-m, :-n]
+
+
 # Data processing algorithms
 #
 # These functions implement the biological- and cognitive-inspired algorithms
 # that prompted the devlopment of Skeye.
 
 
-def correlate(image, filter):
+class identitycache(object):
+    r'''Base class for caches of values derived from objects (e.g. search
+        templates) that are used over and over again.
+
+        Values are keyed by the identity of the source object plus any extra
+        arguments, and kept for as long as the source object is alive -- but
+        no more than maxsize values, taking up no more than maxbytes bytes of
+        array data, are kept at once, the least recently used being discarded
+        first. Either bound can be set to None to disable it, and both can be
+        changed at any time. Subclasses implement the compute() method.
+
+        Caches can be used from several threads at once. Values are computed
+        outside the cache's lock, so a value requested by two threads at the
+        same time may be computed twice.
+    '''
+    def __init__(self, maxsize=32, maxbytes=None):
+        r'''Creates a new, empty cache.
+        '''
+        self.cache = OrderedDict()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.lock = RLock()
+
+    def __call__(self, source, *args):
+        r'''Returns the value derived from the source object and arguments,
+            computing it if it's not yet cached.
+        '''
+        cache = self.cache
+        key = (id(source),) + args
+        with self.lock:
+            entry = cache.pop(key, None)
+            if entry != None and entry[0]() is source:
+                cache[key] = entry
+                return entry[1]
+
+            if entry != None:
+                self.nbytes -= entry[2]
+
+        value = self.compute(source, *args)
+        self.store(value, source, *args)
+        return value
+
+    def store(self, value, source, *args):
+        r'''Caches a value derived from the source object and arguments, e.g.
+            one computed ahead of time.
+        '''
+        cache = self.cache
+        key = (id(source),) + args
+        lock = self.lock
+
+        def expire(reference):
+            with lock:
+                if key in cache and cache[key][0] is reference:
+                    self.nbytes -= cache.pop(key)[2]
+
+        size = _nbytes(value)
+        with lock:
+            replaced = cache.pop(key, None)
+            if replaced != None:
+                self.nbytes -= replaced[2]
+
+            cache[key] = (ref(source, expire), value, size)
+            self.nbytes += size
+            while len(cache) > 1 and self.__overflowing():
+                self.nbytes -= cache.popitem(last=False)[1][2]
+
+    def __overflowing(self):
+        return (
+            (self.maxsize != None and len(self.cache) > self.maxsize) or
+            (self.maxbytes != None and self.nbytes > self.maxbytes)
+        )
+
+    def compute(self, source, *args):
+        r'''Computes the value derived from the source object and arguments.
+        '''
+        raise NotImplementedError()
+
+    def clear(self):
+        r'''Discards all cached values.
+        '''
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+
+
+def _nbytes(value):
+    r'''Returns the number of bytes of array data held by a value, which may
+        be an array or a list or tuple of them.
+    '''
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+
+    return getattr(value, 'nbytes', 0)
+
+
+@singleton
+class spectra(identitycache):
+    r'''Cache of template spectra.
+
+        Transforming a search template costs as much as transforming the image
+        it's searched in, yet the same template is usually searched for in many
+        images of the same size (e.g. successive screenshots). Spectra are
+        therefore kept, keyed by template identity and target shape, for as
+        long as the template itself is alive.
+
+        Since a single template may have spectra for several shapes (e.g.
+        windowed searches) and scales (see templatesearch_scaled()), the cache
+        is bounded by size in bytes rather than number of spectra: 1 GB by
+        default, about 60 spectra for 1080p scenes in double precision (twice
+        that in single precision, see fourier.configure()).
+    '''
+    def __init__(self):
+        identitycache.__init__(self, maxsize=None, maxbytes=2 ** 30)
+
+    def compute(self, filter, shape):
+        r'''Returns the complex conjugate of the spectrum of the (zero-mean)
+            filter, zero-padded to the given shape.
+        '''
+        return conj(fourier.rfft2(fourier.center(filter), shape))
+
+
+@singleton
+class pyramids(identitycache):
+    r'''Cache of template pyramids.
+
+        A template's pyramid only needs to be built once, no matter how many
+        coarse-to-fine searches it's used in. Pyramids don't include the
+        template itself, which would otherwise be kept alive by its own cache
+        entry (along with whatever larger array it may be a view of).
+    '''
+    def compute(self, template, levels):
+        r'''Returns a list of the template at successively halved resolutions,
+            starting from half the template's, with levels items in total.
+        '''
+        pyramid = []
+        level = template
+        for i in range(levels):
+            level = decimate(level)
+            pyramid.append(level)
+
+        return pyramid
+
+
+@singleton
+class scalebanks(identitycache):
+    r'''Cache of template scale banks.
+
+        A template is resized to each scale only once, no matter how many
+        multi-scale searches it's used in. Since resized templates are kept
+        alive along with the bank, their spectra stay cached as well. Banks
+        don't include the template itself, which would otherwise be kept alive
+        by its own cache entry.
+    '''
+    def compute(self, template, scales, phase):
+        r'''Returns a list of the template resized to each of the given scales
+            (see rescale()), with None in place of scale 1.
+        '''
+        return [rescale(template, scale, phase) if scale != 1 else None for scale in scales]
+
+
+@singleton
+class fourier(object):
+    r'''Fourier transform backend used by the correlation functions.
+
+        By default, transforms are computed by numpy.fft in double precision,
+        on a single thread. configure() can select instead a multithreaded
+        library -- scipy.fft, or pyfftw, which also reuses FFT plans across
+        calls -- and single precision (float32 / complex64) data, halving
+        memory traffic.
+    '''
+    def __init__(self):
+        self.configure('numpy')
+
+    def configure(self, library=None, dtype=float64, workers=1):
+        r'''Selects the FFT library ('numpy', 'scipy' or 'pyfftw', or if None
+            the best one available), the floating-point type of transformed
+            data, and the number of worker threads (-1 for one per CPU).
+            Cached template spectra are discarded.
+        '''
+        if workers < 0:
+            from multiprocessing import cpu_count
+            workers = cpu_count()
+
+        names = [library] if library != None else ['pyfftw', 'scipy', 'numpy']
+        for name in names:
+            try:
+                (self.__forward, self.__inverse, self.__options) = self.__load(name, workers)
+                break
+            except ImportError:
+                if name == names[-1]:
+                    raise
+
+        self.library = name
+        self.workers = workers
+        self.dtype = datatype(dtype)
+        self.complex = result_type(self.dtype, complex64)
+        spectra.clear()
+
+    def __load(self, name, workers):
+        if name == 'pyfftw':
+            from pyfftw.interfaces import cache, numpy_fft
+            cache.enable()
+
+            # Plans are otherwise dropped after 0.1s unused, i.e. between
+            # frames of any but the fastest polling loops
+            cache.set_keepalive_time(3600)
+            return (numpy_fft.rfft2, numpy_fft.irfft2, {'threads': workers})
+        elif name == 'scipy':
+            from scipy.fft import rfft2, irfft2
+            return (rfft2, irfft2, {'workers': workers})
+        elif name == 'numpy':
+            from numpy.fft import rfft2, irfft2
+            return (rfft2, irfft2, {})
+
+        raise ValueError('Unknown FFT library: %s' % name)
+
+    def center(self, data):
+        r'''Returns a zero-mean copy of the data, in the configured type.
+        '''
+        data = data.astype(self.dtype)
+        data -= data.mean()
+        return data
+
+    def rfft2(self, data, shape=None):
+        r'''Returns the 2-dimensional real-input FFT of the data (over its last
+            two axes), zero-padded or cropped to the given shape.
+        '''
+        data = data.astype(self.dtype, copy=False)
+        signals = self.__forward(data, shape, **self.__options)
+        return signals.astype(self.complex, copy=False)
+
+    def irfft2(self, data, shape):
+        r'''Returns the inverse of rfft2(), for an output of the given shape.
+        '''
+        signals = self.__inverse(data, shape, **self.__options)
+        return signals.astype(self.dtype, copy=False)
+
+
+def correlate(image, filter, spectrum=None):
     r'''Performs a normalized cross-correlation between an image and a search
         template. For more details, see:
 
         http://en.wikipedia.org/wiki/Cross_correlation#Normalized_cross-correlation
+
+        The template's spectrum is taken from the spectra cache, so repeated
+        searches for the same template only pay for the image's transform. If
+        the image's own transform fourier.rfft2(fourier.center(image)) is
+        already known, it can be given as spectrum, and is then used as is.
+    '''
+    si = spectrum if spectrum is not None else fourier.rfft2(fourier.center(image))
+    return fourier.irfft2(si * spectra(filter, image.shape), image.shape)
+
+
+def normcorrelate(image, template, spectrum=None):
+    r'''Performs a true normalized cross-correlation between an image and a
+        search template.
+
+        Unlike correlate(), which only subtracts the mean, each position is
+        normalized by the energy of the image window under the template. Window
+        energies are computed from summed-area tables, at constant cost per
+        position. Returns a dense map of scores in the range [-1, 1], one for
+        each position where the template fits entirely within the image. See
+        correlate() for the spectrum argument.
+    '''
+    image = image - mean(image)
+    signals = correlate(image, template, spectrum)
+    tables = (integral(image), integral(image ** 2))
+    return _normalize(signals, template, tables)
+
+
+def _normalize(signals, template, tables):
+    r'''Turns the correlation signals of a template against a zero-mean image
+        into normalized cross-correlation scores, given the image's summed-area
+        tables of values and squared values.
+    '''
+    (m, n) = template.shape
+    (rows, cols) = tables[0].shape
+    if m >= rows or n >= cols:
+        return zeros((0, 0))
+
+    sums = windowsum(tables[0], template.shape)
+    squares = windowsum(tables[1], template.shape)
+    energy = maximum(squares - sums ** 2 / (m * n), 0)
+
+    denominator = sqrt(energy) * mag(template - mean(template))
+    denominator[denominator < 1e-9] = inf
+
+    numerator = signals[:sums.shape[0], :sums.shape[1]]
+    return clip(numerator / denominator, -1, 1)
+
+
+def templatesearch(image, template, normalized=False, levels=0, spectrum=None):
+    r'''Searches for a template within a larger image, returning a (spot,
+        topleft, precision) triple.
+
+        By default the match is located at the peak of the mean-subtracted
+        correlation, and its precision is the cosine of the angle between the
+        template and the matching spot. If normalized is True, the match is
+        located on the normalized cross-correlation map instead, and its score
+        there is used as precision.
+
+        If levels is greater than zero, a coarse-to-fine search is performed:
+        candidate matches are first located on versions of the image and
+        template decimated levels times (see decimate()), then each is refined
+        at full resolution within a small window around it, and the best
+        refined match is returned. Levels are reduced as needed so that the
+        decimated template is still at least 8 pixels on each side.
+
+        The image's precomputed transform can be given as spectrum (see
+        correlate()); it's ignored by coarse-to-fine searches, which only
+        transform decimated or cropped versions of the image.
+    '''
+    if levels > 0:
+        return _pyramidsearch(image, template, normalized, levels)
+
+    if normalized:
+        scores = normcorrelate(image, template, spectrum)
+        return _spot(image, template, scores, True)
+
+    signals = correlate(image, template, spectrum)
+    return _spot(image, template, signals)
+
+
+def _pyramidsearch(image, template, normalized, levels, candidates=5):
+    r'''Coarse-to-fine template search, see templatesearch().
+
+        Decimation blurs away the details that tell similar spots apart, so
+        the best coarse match is often not the right one. Instead, up to
+        candidates peaks are picked by non-maximum suppression (see _peaks())
+        from the coarse normalized cross-correlation map -- even for plain
+        searches, as raw correlation peaks crowd around high-contrast areas --
+        and each is refined at full resolution.
     '''
-    si = rfft2(image - mean(image))
-    sf = rfft2(filter - mean(filter), image.shape)
-    return irfft2(si * conj(sf))
+    while levels > 0 and min(template.shape) >> levels < 8:
+        levels -= 1
+
+    if levels == 0:
+        return templatesearch(image, template, normalized)
+
+    coarse = image
+    for i in range(levels):
+        coarse = decimate(coarse)
+
+    reduced = pyramids(template, levels)[-1]
+    scores = normcorrelate(coarse, reduced)
+    (rows, cols, values) = _peaks(scores, reduced.shape, -inf, candidates)
+    if len(values) == 0:
+        raise failure()
+
+    scale = 2 ** levels
+    best = None
+    for coarsetopleft in izip(rows, cols):
+        index = tuple(
+            slice(max(0, i * scale - scale), min(m, i * scale + n + scale))
+            for (i, n, m) in izip(coarsetopleft, template.shape, image.shape)
+        )
+
+        (spot, offset, precision) = templatesearch(image[index], template, normalized)
+        if best == None or precision > best[2]:
+            topleft = tuple(k.start + i for (k, i) in izip(index, offset))
+            best = (spot, topleft, precision)
+
+    return best
+
+
+def templatesearch_many(image, templates, normalized=False, spectrum=None):
+    r'''Searches for several templates within the same image.
+
+        The image is transformed only once (or not at all, if its transform is
+        given as spectrum -- see correlate()), and each template is correlated
+        against that one transform in turn, so only one template's correlation
+        signals are held in memory at a time. Returns a list of (spot, topleft,
+        precision) triples, in the same order as the templates.
+    '''
+    if len(templates) == 0:
+        return []
+
+    centered = fourier.center(image)
+    si = spectrum if spectrum is not None else fourier.rfft2(centered)
+    tables = (integral(centered), integral(centered ** 2)) if normalized else None
+
+    results = []
+    for template in templates:
+        signals = correlate(image, template, si)
+        if normalized:
+            results.append(_spot(image, template, _normalize(signals, template, tables), True))
+        else:
+            results.append(_spot(image, template, signals))
+
+    return results
+
+
+def templatesearch_all(image, template, threshold=0.5, k=None, spectrum=None):
+    r'''Searches for every match of a template within a larger image, returning
+        a record array of (topleft, score) pairs, sorted by decreasing score.
+
+        Matches are the peaks of the normalized cross-correlation map (see
+        normcorrelate()) scoring at least threshold. Peaks are picked by
+        non-maximum suppression in a single vectorized pass: a position is kept
+        only if no other within a template-sized window around it scores
+        higher. If k is given, only the best k matches are returned. See
+        correlate() for the spectrum argument.
+    '''
+    scores = normcorrelate(image, template, spectrum)
+    (rows, cols, values) = _peaks(scores, template.shape, threshold, k)
+
+    found = empty(len(values), dtype=[('topleft', int, 2), ('score', float)])
+    found['topleft'][:, 0] = rows
+    found['topleft'][:, 1] = cols
+    found['score'] = values
+    return found
+
+
+def _peaks(scores, shape, threshold, k=None):
+    r'''Returns the (rows, cols, values) arrays of the peaks in a map of
+        scores scoring at least threshold, sorted by decreasing score -- only
+        the best k, if k is given.
+
+        Peaks are picked by non-maximum suppression in a single vectorized
+        pass: a position is kept only if no other within a window of the given
+        shape around it scores higher.
+    '''
+    if scores.size == 0:
+        return (empty(0, dtype=int), empty(0, dtype=int), empty(0))
+
+    peaks = (scores >= threshold) & (scores == maximum_filter(scores, shape, mode='nearest'))
+    (rows, cols) = peaks.nonzero()
+    values = scores[rows, cols]
 
+    # Stable sort, so ties keep their row-major order
+    order = argsort(-values, kind='mergesort')[:k]
+    return (rows[order], cols[order], values[order])
 
-def templatesearch(image, template):
-    image = image.astype(float)
-    template = template.astype(float)
 
-    signals = correlate(image, template)
+def templatesearch_scaled(image, template, scales, normalized=False, spectrum=None, phase=(0, 0)):
+    r'''Searches for a template within a larger image at several scales,
+        returning a (scale, (spot, topleft, precision)) pair for the best match
+        found at any scale.
+
+        The template is resized to each scale once (see scalebanks), and all
+        resized templates are searched for in a single batched pass over one
+        transform of the image (see templatesearch_many()), instead of
+        resizing and searching the image once per scale. Scales at which the
+        template doesn't fit in the image are skipped. See correlate() for the
+        spectrum argument, and rescale() for the phase argument.
+    '''
+    scales = tuple(scales)
+    bank = [
+        resized if resized is not None else template
+        for resized in scalebanks(template, scales, tuple(phase))
+    ]
+
+    fitting = [
+        i for (i, resized) in enumerate(bank)
+        if all(n < m for (n, m) in izip(resized.shape, image.shape))
+    ]
+
+    if len(fitting) == 0:
+        raise failure()
+
+    templates = [bank[i] for i in fitting]
+    results = templatesearch_many(image, templates, normalized, spectrum)
+    best = argmax([precision for (spot, topleft, precision) in results])
+    return (scales[fitting[best]], results[best])
+
+
+def _spot(image, template, signals, normalized=False):
+    r'''Returns the (spot, topleft, precision) triple for the highest peak in
+        the correlation signals of a template against an image.
+
+        Only offsets where the template fits entirely within the image are
+        considered -- circular correlation wraps the template around the
+        image's borders everywhere else. A failure is raised if there are none.
+    '''
+    signals = _valid(image, template, signals)
+    if signals.size == 0:
+        raise failure()
+
     topleft = searchmax(signals)
 
     index = tuple(slice(i, i + n) for (i, n) in izip(topleft, template.shape))
-    spot = image[index]
-    precision = angle(crop(template, spot.shape), spot)
+    spot = image[index].astype(float)
+    if normalized:
+        precision = signals[topleft]
+    else:
+        precision = angle(crop(template, spot.shape).astype(float), spot)
 
     return (spot, topleft, precision)
 
 
+def _valid(image, template, signals):
+    r'''Crops the correlation signals of a template against an image to the
+        offsets where the template fits entirely within the image.
+    '''
+    valid = tuple(slice(0, max(0, m - n + 1)) for (m, n) in izip(image.shape, template.shape))
+    return signals[valid]
+
+
+def rescale(mosaic, scale, phase=(0, 0)):
+    r'''Resizes a Bayer mosaic by the given factor. The mosaic is demosaicked,
+        resized in full colour and then mosaicked again, so that each pixel
+        keeps sampling the right colour.
+
+        Mosaics cut from a larger one (e.g. search templates) at odd
+        coordinates start off the pattern; phase gives the parity of those
+        coordinates, i.e. (row % 2, column % 2), so that they're demosaicked
+        correctly, and the resized mosaic starts at the same point of the
+        pattern. At scale 1 the mosaic is returned as is.
+    '''
+    if scale == 1:
+        return mosaic
+
+    (r, c) = phase
+    aligned = pad(mosaic, ((r, 0), (c, 0)), mode='reflect')
+    colour = bayer.demosaic(aligned)[r:, c:]
+
+    (m, n) = mosaic.shape
+    size = (max(1, int(round(n * scale))), max(1, int(round(m * scale))))
+    resized = snapshot(toimage(colour, cmin=0, cmax=255).resize(size, ANTIALIAS))
+    resized = pad(resized, ((r, 0), (c, 0), (0, 0)), mode='edge')
+    return bayer(resized)[r:, c:]
+
+
 @singleton
 class bayer(object):
-    def __init__(self):
-        self.filters = {}
-        self.largest = (zeros((0, 0)),)
+    r'''Converts colour images to Bayer mosaics.
 
-    def __call__(self, image=None):
+        Mosaics follow a BGGR pattern: even rows alternate blue and green
+        pixels, odd rows alternate green and red.
+    '''
+    # (rows, columns, colour channel) of each quarter of the mosaic
+    pattern = (
+        (slice(0, None, 2), slice(0, None, 2), 2), # Blue
+        (slice(0, None, 2), slice(1, None, 2), 1), # Green
+        (slice(1, None, 2), slice(0, None, 2), 1), # Green
+        (slice(1, None, 2), slice(1, None, 2), 0)  # Red
+    )
+
+    def __call__(self, image=None, out=None):
+        r'''Returns the Bayer mosaic of the given image (see snapshot()).
+            Images that are already 2-dimensional are returned as is.
+
+            If given, the out array is used to store the mosaic, instead of
+            allocating a new one.
+        '''
         inputs = snapshot(image)
-        filter = self.__getfilter(inputs.shape[0:2])
-        return inputs[filter]
-
-    def __getfilter(self, shape):
-        def bayerfilter(shape):
-            plane = tuple(i for i in indices(shape))
-            colors = (
-                # where(logical_and(indexes[0] % 2 != 0, indexes[1] % 2 != 0), 0, 0) + # Red # No need to specify red, as its index is 0
-                where(logical_xor(plane[0] % 2 == 0, plane[1] % 2 == 0), 1, 0) + # Green
-                where(logical_and(plane[0] % 2 == 0, plane[1] % 2 == 0), 2, 0) # Blue
-            )
-
-            return plane + (colors,)
+        if inputs.ndim == 2:
+            return inputs
 
-        filter = self.filters.get(shape)
-        if filter == None:
-            if all(a > b for (a, b) in izip(self.largest[0].shape, shape)):
-                index = tuple(slice(0, n) for n in shape)
-                filter = tuple(ranges[index] for ranges in self.largest)
-            else:
-                filter = bayerfilter(shape)
-                self.largest = filter
+        if out is None:
+            out = empty(inputs.shape[0:2], dtype=inputs.dtype)
 
-            self.filters[shape] = filter
+        for (rows, cols, channel) in self.pattern:
+            out[rows, cols] = inputs[rows, cols, channel]
 
-        return filter
+        return out
 
     def filter(self, image):
         data = snapshot(image)
@@ -263,8 +885,37 @@ class bayer(object):
         return self.toimage(mosaic)
 
     def toimage(self, data):
-        index = self.__getfilter(data.shape)
-        channels = zeros(index[0].shape + (3,))
-        channels[index] = data
-        return toimage(channels)
+        r'''Converts a Bayer mosaic back to a (demosaicked) PIL image.
+        '''
+        return toimage(self.demosaic(data), cmin=0, cmax=255)
+
+    def demosaic(self, data):
+        r'''Reconstructs full colour images from Bayer mosaics by bilinear
+            interpolation.
+
+            Works on single mosaics as well as on whole batches of them, i.e.
+            arrays of shape (..., m, n), returning arrays of shape (..., m, n,
+            3). Each missing sample is the average of the nearest samples of
+            the same colour, computed as a normalized convolution so that
+            borders need no special handling.
+        '''
+        data = asarray(data)
+        channels = zeros(data.shape + (3,))
+        masks = zeros(data.shape[-2:] + (3,))
+        for (rows, cols, channel) in self.pattern:
+            channels[..., rows, cols, channel] = data[..., rows, cols]
+            masks[rows, cols, channel] = 1
 
+        interpolated = _smooth(channels) / _smooth(masks)
+        return where(masks > 0, channels, interpolated)
+
+
+def _smooth(data):
+    r'''Convolves the two axes preceding the last one of the data array with
+        the separable kernel [1, 2, 1] x [1, 2, 1], zero-padding its borders.
+    '''
+    shape = data.shape
+    padded = zeros(shape[:-3] + (shape[-3] + 2, shape[-2] + 2, shape[-1]))
+    padded[..., 1:-1, 1:-1, :] = data
+    rows = padded[..., :-2, :, :] + 2 * padded[..., 1:-1, :, :] + padded[..., 2:, :, :]
+    return rows[..., :-2, :] + 2 * rows[..., 1:-1, :] + rows[..., 2:, :]
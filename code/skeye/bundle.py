@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+r'''Precompiled visual memories.
+
+    Building a reel memory means decoding every reference image and converting
+    it into a Bayer mosaic, and every template then has to be cut from its
+    mosaic and transformed on first use. 'save()' does all that once, writing
+    the results to a bundle directory: a JSON manifest, plus a numpy .npy file
+    for each mosaic, template, template spectrum and ROI raster, and a pickle
+    of each visual map's descriptors. 'load()' rebuilds the reel memory from a
+    bundle, memory-mapping its arrays, so pages are only read from disk when
+    actually used -- and shared among all processes loading the same bundle.
+'''
+
+__license__ = r'''
+Copyright (c) Helio Perroni Filho <xperroni@gmail.com>
+
+This file is part of Skeye.
+
+Skeye is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Skeye is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Skeye. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__version__ = '1'
+
+import json
+from cPickle import dump, load as unpickle, HIGHEST_PROTOCOL
+from os import makedirs
+from os.path import isdir, join
+
+import numpy
+from numpy import asarray
+
+from skeye import failure, fourier, spectra
+from skeye.cogs import latch, reelmemory, roiset, visualmap, what
+
+
+def save(memory, path, shapes=()):
+    r'''Compiles a reel memory of visual maps into a bundle at the given
+        directory path.
+
+        Besides each visual map's mosaic, descriptors and ROI sets, the bundle
+        holds the templates searched for by its 'what' operations and, for
+        each of the given scene shapes (e.g. the screen resolution), their
+        spectra.
+    '''
+    if not isdir(path):
+        makedirs(path)
+
+    def store(name, data):
+        numpy.save(join(path, name), asarray(data))
+        return name
+
+    maps = []
+    for (i, sight) in enumerate(memory):
+        descriptors = '%d.descriptors.pickle' % i
+        with open(join(path, descriptors), 'wb') as file:
+            dump(sight.descriptors, file, HIGHEST_PROTOCOL)
+
+        templates = []
+        for (k, roi) in enumerate(_templated(sight)):
+            template = sight.template(roi)
+            templates.append({
+                'roi': roi,
+                'data': store('%d.template.%d.npy' % (i, k), template),
+                'spectra': [
+                    {
+                        'shape': shape,
+                        'data': store('%d.spectrum.%d.%dx%d.npy' % ((i, k) + tuple(shape)), spectra(template, tuple(shape)))
+                    }
+                    for shape in shapes
+                ]
+            })
+
+        rois = {}
+        for (j, (name, contours)) in enumerate(sorted(sight.rois.items())):
+            compiled = {'contours': list(contours), 'raster': None, 'origin': None}
+            if contours.raster is not None:
+                compiled['raster'] = store('%d.raster.%d.npy' % (i, j), contours.raster)
+                compiled['origin'] = contours.origin.tolist()
+
+            rois[name] = compiled
+
+        maps.append({
+            'memory': store('%d.memory.npy' % i, sight.memory),
+            'descriptors': descriptors,
+            'templates': templates,
+            'rois': rois
+        })
+
+    manifest = {'version': 1, 'complex': fourier.complex.str, 'maps': maps}
+    with open(join(path, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+
+def load(path):
+    r'''Loads the reel memory compiled into a bundle at the given directory
+        path (see save()).
+
+        Template spectra are put into the spectra cache, unless they were
+        computed for a different data type than currently configured (see
+        skeye.fourier). Bundles holding many templates may call for a larger
+        cache size (spectra.maxbytes).
+    '''
+    with open(join(path, 'manifest.json')) as file:
+        manifest = json.load(file)
+
+    if manifest['version'] != 1:
+        raise failure('Unsupported bundle version: %s' % manifest['version'])
+
+    def restore(name):
+        return numpy.load(join(path, name), mmap_mode='r')
+
+    memory = reelmemory()
+    for entry in manifest['maps']:
+        with open(join(path, entry['descriptors']), 'rb') as file:
+            descriptors = unpickle(file)
+
+        rois = {}
+        for (name, compiled) in entry['rois'].items():
+            contours = [_tuple(contour) for contour in compiled['contours']]
+            raster = None
+            origin = None
+            if compiled['raster'] != None:
+                raster = restore(compiled['raster'])
+                origin = asarray(compiled['origin'], dtype=int)
+
+            rois[str(name)] = roiset(contours, (raster, origin))
+
+        sight = visualmap(restore(entry['memory']), *descriptors.items(), **rois)
+        for stored in entry['templates']:
+            roi = _tuple(stored['roi'])
+            template = restore(stored['data'])
+            sight.templates[roi] = template
+            if manifest['complex'] != fourier.complex.str:
+                continue
+
+            for spectrum in stored['spectra']:
+                spectra.store(restore(spectrum['data']), template, tuple(spectrum['shape']))
+
+        memory.append(sight)
+
+    return memory
+
+
+def _templated(sight):
+    r'''Returns the ROI's of the templates searched for by the 'what'
+        operations of a visual map's descriptors, without repetitions.
+    '''
+    rois = []
+    for descriptor in sight.descriptors.values():
+        actions = descriptor.actions if isinstance(descriptor, latch) else ()
+        for action in actions:
+            if isinstance(action, what) and action.bounds not in rois:
+                rois.append(action.bounds)
+
+    return rois
+
+
+def _tuple(values):
+    r'''Turns nested lists (e.g. read from JSON) into nested tuples.
+    '''
+    if isinstance(values, list):
+        return tuple(_tuple(value) for value in values)
+
+    return values
@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+r'''Screen capture backends.
+
+    Screenshots are acquired through the 'screen' object, which delegates to
+    one of several interchangeable backends. By default the fastest backend
+    available on the running platform is used, but any other (including any
+    callable returning an image) can be selected with 'screen.use()'.
+'''
+
+__license__ = r'''
+Copyright (c) Helio Perroni Filho <xperroni@gmail.com>
+
+This file is part of Skeye.
+
+Skeye is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Skeye is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Skeye. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__version__ = '1'
+
+import platform
+from ctypes import Structure, POINTER, c_char_p, c_int, c_uint, c_ulong, c_ubyte, c_void_p
+from os import environ
+from threading import Lock
+
+from numpy import empty, frombuffer, uint8
+
+from skeye import singleton, failure
+
+
+class _XImage(Structure):
+    r'''Leading fields of Xlib's XImage structure.
+    '''
+    _fields_ = [
+        ('width', c_int),
+        ('height', c_int),
+        ('xoffset', c_int),
+        ('format', c_int),
+        ('data', c_void_p),
+        ('byte_order', c_int),
+        ('bitmap_unit', c_int),
+        ('bitmap_bit_order', c_int),
+        ('bitmap_pad', c_int),
+        ('depth', c_int),
+        ('bytes_per_line', c_int),
+        ('bits_per_pixel', c_int),
+        ('red_mask', c_ulong),
+        ('green_mask', c_ulong),
+        ('blue_mask', c_ulong)
+    ]
+
+
+class _screen_x11(object):
+    r'''X11 screen grabber, copies the root window's pixels straight into a
+        numpy array through Xlib's XGetImage(), with no file round-trip.
+
+        The display is taken from the DISPLAY environment variable, unless
+        given explicitly -- so the grabber can also be run headless against a
+        virtual framebuffer such as Xvfb.
+
+        Xlib connections are not thread-safe, so screenshots taken from several
+        threads at once (e.g. by a capture hub and concurrent batch workers)
+        are serialized.
+    '''
+    def __init__(self, display=None):
+        from ctypes import cdll
+        from ctypes.util import find_library
+
+        xlib = cdll.LoadLibrary(find_library('X11') or 'libX11.so.6')
+        xlib.XOpenDisplay.argtypes = [c_char_p]
+        xlib.XOpenDisplay.restype = c_void_p
+        xlib.XDefaultScreen.argtypes = [c_void_p]
+        xlib.XDefaultScreen.restype = c_int
+        xlib.XDisplayWidth.argtypes = [c_void_p, c_int]
+        xlib.XDisplayWidth.restype = c_int
+        xlib.XDisplayHeight.argtypes = [c_void_p, c_int]
+        xlib.XDisplayHeight.restype = c_int
+        xlib.XDefaultRootWindow.argtypes = [c_void_p]
+        xlib.XDefaultRootWindow.restype = c_ulong
+        xlib.XGetImage.argtypes = [c_void_p, c_ulong, c_int, c_int, c_uint, c_uint, c_ulong, c_int]
+        xlib.XGetImage.restype = POINTER(_XImage)
+        xlib.XDestroyImage.argtypes = [POINTER(_XImage)]
+
+        self.__display = xlib.XOpenDisplay(display)
+        if not self.__display:
+            raise failure('Could not open X display %s' % (display or environ.get('DISPLAY')))
+
+        self.__xlib = xlib
+        self.__root = xlib.XDefaultRootWindow(self.__display)
+        self.__lock = Lock()
+
+    def __call__(self):
+        with self.__lock:
+            return self.__grab()
+
+    def __grab(self):
+        xlib = self.__xlib
+        display = self.__display
+        screen = xlib.XDefaultScreen(display)
+        width = xlib.XDisplayWidth(display, screen)
+        height = xlib.XDisplayHeight(display, screen)
+
+        AllPlanes = 0xffffffff
+        ZPixmap = 2
+        image = xlib.XGetImage(display, self.__root, 0, 0, width, height, AllPlanes, ZPixmap)
+        if not image:
+            raise failure('XGetImage() failed')
+
+        try:
+            header = image.contents
+            if header.bits_per_pixel != 32:
+                raise failure('Unsupported pixel format: %d bpp' % header.bits_per_pixel)
+
+            size = header.bytes_per_line * height
+            data = frombuffer((c_ubyte * size).from_address(header.data), uint8)
+            pixels = data.reshape((height, header.bytes_per_line // 4, 4))[:, :width]
+
+            # Byte offset of each colour within a pixel, derived from its mask
+            # and the server's byte order (0 = LSBFirst, 1 = MSBFirst)
+            def offset(mask):
+                shift = mask.bit_length() - 8
+                return shift // 8 if header.byte_order == 0 else 3 - shift // 8
+
+            rgb = empty((height, width, 3), uint8)
+            for (i, mask) in enumerate((header.red_mask, header.green_mask, header.blue_mask)):
+                rgb[:, :, i] = pixels[:, :, offset(mask)]
+
+            return rgb
+        finally:
+            xlib.XDestroyImage(image)
+
+
+class _screen_grab(object):
+    r'''PIL screen grabber, available on Windows and Mac OS.
+    '''
+    def __init__(self):
+        from ImageGrab import grab
+        self.__grab = grab
+
+    def __call__(self):
+        return self.__grab()
+
+
+class _screen_scrot(object):
+    r'''Fallback screen grabber, saves a screenshot to a file through scrot
+        and loads it back.
+
+        http://freecode.com/projects/scrot
+    '''
+    def __init__(self, name='screenshot.png'):
+        self.name = name
+
+    def __call__(self):
+        from os import system
+        from Image import open as loadimage
+
+        system('scrot %s' % self.name)
+        image = loadimage(self.name)
+        image.load()
+        return image
+
+
+@singleton
+class screen(object):
+    r'''Screen capture API.
+
+        Calling the 'screen' object grabs a screenshot, either as a PIL image
+        or as a numpy array, depending on the backend in use. Available
+        backends are:
+
+        * 'x11' -- reads pixels straight from the X server into memory;
+
+        * 'grab' -- uses PIL's ImageGrab module (Windows and Mac OS only);
+
+        * 'scrot' -- saves the screenshot to a file through scrot, then loads it.
+
+        Unless otherwise selected, the first backend that works on the running
+        platform is used, in the order above.
+    '''
+    def __init__(self):
+        self.__backend = None
+
+    def __call__(self):
+        return self.__getbackend()()
+
+    def use(self, backend, *args, **options):
+        r'''Selects the capture backend, either by name or as any callable that
+            returns an image. Extra arguments are passed on to named backends'
+            constructors.
+        '''
+        backends = {'x11': _screen_x11, 'grab': _screen_grab, 'scrot': _screen_scrot}
+        if isinstance(backend, basestring):
+            backend = backends[backend](*args, **options)
+
+        self.__backend = backend
+
+    def __getbackend(self):
+        if self.__backend == None:
+            candidates = [_screen_grab, _screen_scrot]
+            if platform.system() != 'Windows' and 'DISPLAY' in environ:
+                candidates.insert(0, _screen_x11)
+
+            for candidate in candidates:
+                try:
+                    self.__backend = candidate()
+                    break
+                except (ImportError, OSError, failure):
+                    pass
+
+        return self.__backend
@@ -30,6 +30,19 @@ r'''A framework for programming simple cognitive tasks.
     arguments it was invoked with and returns the list of outputs, whereas
     'latch' passes the input arguments plus the output of the previous command
     in the sequence, and returns the output of the last command.
+
+    Cogbots can also be run as coroutines on a 'skeye.reactor' loop, so that
+    many of them run at once on a single thread: waits between polled frames
+    then no longer block, and template searches run on the loop's worker
+    threads. Commands providing a coroutine() method are run through it, and
+    any others on a worker thread (see skeye.reactor.awaitable).
+
+    Running commands can be traced by passing a 'trace' object to tracing():
+    the actions of every 'batch' and 'latch', the stages of 'what' searches
+    and each frame polled by 'locate' are then recorded as nested spans, named
+    after the commands' string representations, which can be exported as
+    Chrome trace events. Tracing is disabled by default, at the cost of a
+    single check per command.
 '''
 
 __license__ = r'''
@@ -53,44 +66,204 @@ along with Skeye. If not, see <http://www.gnu.org/licenses/>.
 
 __version__ = '1'
 
-from itertools import izip, product
-from time import sleep
+import json
+import platform
+from collections import Iterator, OrderedDict
+from contextlib import contextmanager
+from itertools import izip
+from os import getpid
+from threading import Lock, current_thread
+from time import sleep, time
 
 from Image import open as open_image
 from ImageDraw import Draw
 
-from skeye import fancy_index, ballot, failure, varargs
-from skeye import bayer, templatesearch
+from numpy import ndarray, arange, asarray, bincount, clip, empty, flatnonzero, lexsort
+from numpy import int16, int32, maximum, minimum
+
+from skeye import fancy_index, fingerprint, failure, varargs
+from skeye import overlap
+from skeye import bayer, spectra, templatesearch, templatesearch_all, templatesearch_many
+from skeye import ncc, scalebanks, templatesearch_scaled
 from skeye import effectors
+from skeye.sources import hub
+from skeye.reactor import awaitable, offload, result, wait
 
 
 Screenshot = None
 
 
+# Tracer recording the spans of running commands, if any (see tracing())
+_tracer = None
+
+
+def tracing(tracer):
+    r'''Sets the tracer recording the spans of running commands (e.g. a 'trace'
+        object), or disables tracing if tracer is None. Returns the previous
+        tracer.
+    '''
+    global _tracer
+    (previous, _tracer) = (_tracer, tracer)
+    return previous
+
+
+class trace(object):
+    r'''Records the nested spans of running commands, and exports them as
+        Chrome trace events, which can be viewed in chrome://tracing or
+        Perfetto. Spans are recorded per thread, so concurrent batches show up
+        as separate tracks.
+    '''
+    def __init__(self):
+        self.origin = time()
+        self.events = []
+
+    @contextmanager
+    def span(self, name):
+        r'''Records the time spent within the context as a span of the given
+            name. Spans ended by an exception are marked with it.
+        '''
+        args = {}
+        start = time()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            end = time()
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': getpid(),
+                'tid': current_thread().ident,
+                'args': args
+            })
+
+    def export(self):
+        r'''Returns the recorded spans in Chrome's trace event format.
+        '''
+        return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        r'''Saves the recorded spans as a Chrome trace event file.
+        '''
+        with open(path, 'w') as file:
+            json.dump(self.export(), file)
+
+
+def _call(name, function, *args, **kwargs):
+    r'''Calls the function with the given arguments, recording a span for it if
+        tracing is enabled. The span's name is the string representation of
+        name -- or if name is an (owner, stage) pair, of the owner followed by
+        the stage -- only worked out when it's actually recorded.
+    '''
+    tracer = _tracer
+    if tracer is None:
+        return function(*args, **kwargs)
+
+    if isinstance(name, tuple):
+        name = '%s %s' % name
+
+    with tracer.span(str(name)):
+        return function(*args, **kwargs)
+
+
 class cogbot(object):
     r'''A CogBot (short for Cognitive Robot) is a simple programmable agent. It
         is mainly composed of a sequence of commands, which may interact with
         the surrounding environment as well as with the agent's memory.
     '''
-    def __init__(self, memory, *commands):
+    def __init__(self, memory, *commands, **options):
         r'''Creates a new CogBot from a pre-set memory and a command sequence.
+            Options are passed on to the 'batch' that runs the commands.
         '''
         self.memory = memory
-        self.commands = batch(*commands)
+        self.commands = batch(*commands, **options)
 
     def __call__(self):
         r'''Runs the CogBot. Programmed commands are executed sequentially.
         '''
         commands = self.commands
-        return commands(context=self)
+        return _call(commands, commands, context=self)
+
+    def coroutine(self):
+        r'''Returns a coroutine running the CogBot on a reactor loop (see
+            skeye.reactor).
+        '''
+        return self.commands.coroutine(context=self)
 
 
 class batch(object):
-    def __init__(self, *actions):
+    r'''Runs a sequence of actions with the same arguments, returning the tuple
+        of their outputs.
+
+        By default actions run one after the other. If the 'workers' option is
+        greater than 1, they run concurrently on a pool of that many threads
+        instead; the 'after' option then maps the index of an action to the
+        indices of earlier actions it must wait for (e.g. {2: (0, 1)}). Outputs
+        are returned in the same order either way, and if any action raises an
+        exception, the first one raised in sequence order is re-raised -- but
+        independent actions may by then have already run.
+    '''
+    def __init__(self, *actions, **options):
         self.actions = actions
+        self.workers = options.get('workers', 0)
+        self.after = options.get('after', {})
+        for (i, prerequisites) in self.after.items():
+            if any(not (0 <= j < i) for j in prerequisites):
+                raise ValueError('Action %d can only wait for earlier actions' % i)
 
     def __call__(self, *args, **context):
-        return tuple(action(*args, **context) for action in self.actions)
+        if self.workers > 1:
+            return self.__concurrent(args, context)
+
+        return tuple(_call(action, action, *args, **context) for action in self.actions)
+
+    def __concurrent(self, args, context):
+        from multiprocessing.pool import ThreadPool
+        from threading import Event
+
+        # Pool results only wake up one waiting thread, so completion is
+        # signalled to dependent actions through separate events
+        done = [Event() for action in self.actions]
+        failed = set()
+
+        def run(i, action):
+            try:
+                for j in self.after.get(i, ()):
+                    done[j].wait()
+                    if j in failed:
+                        raise failure('Action %d depends on failed action %d' % (i, j))
+
+                return _call(action, action, *args, **context)
+            except:
+                failed.add(i)
+                raise
+            finally:
+                done[i].set()
+
+        # Pools start tasks in submission order, and actions only wait for
+        # earlier ones, so waiting can never starve the pool
+        pool = ThreadPool(self.workers)
+        try:
+            pending = [pool.apply_async(run, (i, action)) for (i, action) in enumerate(self.actions)]
+            return tuple(result.get() for result in pending)
+        finally:
+            pool.close()
+            pool.join()
+
+    def coroutine(self, *args, **context):
+        r'''Returns a coroutine running the actions one after the other, for
+            use on a reactor loop.
+        '''
+        outputs = []
+        for action in self.actions:
+            output = yield awaitable(action, *args, **context)
+            outputs.append(output)
+
+        raise result(tuple(outputs))
 
     def __str__(self):
         return tostr('batch', self.actions)
@@ -106,22 +279,59 @@ class latch(object):
             if not isinstance(args, varargs):
                 args = (args,)
 
-            args = action(*args, **context)
+            args = _call(action, action, *args, **context)
 
         return args
 
+    def coroutine(self, *args, **context):
+        r'''Returns a coroutine chaining the actions, for use on a reactor
+            loop.
+        '''
+        args = varargs(args)
+        for action in self.actions:
+            if not isinstance(args, varargs):
+                args = (args,)
+
+            args = yield awaitable(action, *args, **context)
+
+        raise result(args)
+
     def __str__(self):
         return tostr('latch', self.actions)
 
 
 class reelmemory(list):
     r'''A simple sequencial memory.
+
+        Given a 'resident' option, at most that many of the visual maps
+        accessed by index are kept decoded at once: whenever another one is
+        accessed, the least recently accessed is released (see
+        visualmap.release), to be decoded again when next used. Maps can be
+        accessed from several threads at once (e.g. by concurrent batches).
     '''
-    def __init__(self, *memories):
+    def __init__(self, *memories, **options):
         r'''Creates a new reel memory out of a collection of individual
             memories.
         '''
         self.extend(memories)
+        self.resident = options.get('resident')
+        self.__recent = OrderedDict()
+        self.__lock = Lock()
+
+    def __getitem__(self, index):
+        memory = list.__getitem__(self, index)
+        if self.resident == None or not isinstance(memory, visualmap):
+            return memory
+
+        recent = self.__recent
+        with self.__lock:
+            recent.pop(id(memory), None)
+            recent[id(memory)] = memory
+            while len(recent) > self.resident:
+                (key, evicted) = recent.popitem(last=False)
+                evicted.release()
+
+        return memory
 
 
 class descript(tuple):
@@ -142,15 +352,19 @@ class percept(object):
         information on its position and dimensions, possibly relative to a
         larger, "parent" percept.
     '''
-    def __init__(self, data, offset=(0, 0), parent=None):
+    def __init__(self, data, offset=(0, 0), parent=None, spectrum=None):
         r'''Creates a new percept out of a raw pixel data object, a position
             offset and an optional parent percept. If the parent percept is
             supplied, the offset is taken to be relative to this parent,
             otherwise it is taken as relative to the overall scene.
+
+            The data's transform, if already known (see skeye.correlate), can
+            be given as spectrum, and is then reused by searches over it.
         '''
         self.data = data
         self.offset = offset
         self.parent = parent
+        self.spectrum = spectrum
 
     @property
     def center(self):
@@ -181,15 +395,44 @@ class visualmap(object):
     r'''A memory of a visual scene, from which various objects may be
         discretized by sequences of differentiation ("what") and/or integration
         ("where") operations.
+
+        The memory's image is only decoded and converted into a Bayer mosaic
+        when first needed, so maps that are never used cost next to nothing.
     '''
     def __init__(self, memory, *descriptors, **rois):
         r'''Creates a new visual map out of a memory object, a collection of
             object descriptors, and an optional dictionary of Regions of
             Interest (ROI's).
         '''
-        self.memory = bayer(memory)
+        self.source = memory
+        self.__memory = None
         self.descriptors = dict(descriptors)
-        self.rois = rois
+        self.rois = dict(
+            (name, contours if isinstance(contours, roiset) else roiset(contours))
+            for (name, contours) in rois.items()
+        )
+        self.templates = {}
+
+    @property
+    def memory(self):
+        r'''Returns the Bayer mosaic of the memory's image, decoding it on first
+            access.
+        '''
+        if self.__memory is None:
+            self.__memory = bayer(self.source)
+
+        return self.__memory
+
+    def release(self):
+        r'''Discards the decoded memory and the templates extracted from it
+            (along with their cached spectra), unless the memory can't be
+            decoded again, i.e. it was given as a frame source.
+        '''
+        if isinstance(self.source, Iterator):
+            return
+
+        self.__memory = None
+        self.templates = {}
 
     def __call__(self, label, inputs):
         r'''Searches for the the labeled object in a new scene, represented by
@@ -198,6 +441,73 @@ class visualmap(object):
         descriptor = self.descriptors[label]
         return descriptor(inputs, context=self)
 
+    def survey(self, labels, inputs):
+        r'''Searches for several labeled objects in the same scene at once.
+
+            The leading 'what' operations of all descriptors are run as a single
+            batched template search, which transforms the scene only once; any
+            remaining operations then proceed as usual. Returns the list of
+            percepts, in the same order as the labels.
+        '''
+        descriptors = [self.descriptors[label] for label in labels]
+        batched = self.__batchable(descriptors)
+
+        found = {}
+        for normalized in (False, True):
+            group = [i for i in batched if descriptors[i].actions[0].normalized == normalized]
+            templates = [descriptors[i].actions[0].template(self) for i in group]
+            results = templatesearch_many(inputs.data, templates, normalized, inputs.spectrum)
+            found.update(izip(group, results))
+
+        percepts = []
+        for (i, descriptor) in enumerate(descriptors):
+            if i not in found:
+                percepts.append(descriptor(inputs, context=self))
+                continue
+
+            actions = descriptor.actions
+            spotted = actions[0].accept(found[i], inputs)
+            if len(actions) > 1:
+                spotted = latch(*actions[1:])(spotted, context=self)
+
+            percepts.append(spotted)
+
+        return percepts
+
+    def prepare(self, labels, shape):
+        r'''Computes ahead of time the spectra of the templates searched for by
+            the leading 'what' operations of the labeled descriptors, for
+            scenes of the given shape.
+        '''
+        descriptors = [self.descriptors[label] for label in labels]
+        for i in self.__batchable(descriptors):
+            head = descriptors[i].actions[0]
+            spectra(head.template(self), shape)
+
+    def __batchable(self, descriptors):
+        r'''Returns the indices of the descriptors whose leading operation is
+            a 'what' that can be run as part of a batched search.
+        '''
+        return [
+            i for (i, descriptor) in enumerate(descriptors)
+            if isinstance(descriptor, latch) and len(descriptor.actions) > 0
+            and isinstance(descriptor.actions[0], what)
+            and descriptor.actions[0].batchable
+        ]
+
+    def template(self, roi):
+        r'''Returns the region of the memory delimited by the given ROI.
+
+            Regions are extracted only once and then kept, so that successive
+            searches for the same template can reuse its cached spectrum.
+        '''
+        template = self.templates.get(roi)
+        if template is None:
+            template = self.memory[fancy_index(roi)]
+            self.templates[roi] = template
+
+        return template
+
 
 def tostr(name, children):
     tab = ' ' * 4
@@ -209,13 +519,158 @@ def tostr(name, children):
 
 
 class what(object):
+    r'''Differentiation operation: searches the scene for a template taken
+        from the visual map's memory.
+
+        By default the whole scene is searched every time. Given a 'margin'
+        option, the search first looks within that many pixels around the
+        previous match; given a 'window' option ((r0, rn), (c0, cn)), it first
+        looks within that region of the scene (unless a margin around a
+        previous match is also available). If the template isn't there (e.g.
+        the object has moved), the best match in the region is still some
+        wrong spot, which often clears the required precision -- angles
+        between unrelated spots of the same screen run as high as 0.9. So the
+        match found there is only accepted if its normalized cross-correlation
+        score (see skeye.normcorrelate) also reaches the 'confidence' option,
+        0.75 by default; otherwise the whole scene is searched. Counters 'hits'
+        and 'fallbacks' keep track of how often the first search succeeded or
+        failed.
+
+        Given a 'matches' option, the whole scene is searched instead for every
+        match scoring at least the required precision on the normalized
+        cross-correlation map, and the list of percepts is returned, best
+        first -- at most 'matches' of them, or all if 'matches' is 0.
+
+        Given a 'scales' option (a sequence of factors such as (0.8, 1.0,
+        1.25)), the template is searched for at each of those scales instead,
+        for scenes whose pixel scale may differ from the memory's; the scale of
+        the last match is kept in 'scale'.
+    '''
     def __init__(self, *roi, **options):
+        self.bounds = roi
         self.roi = fancy_index(roi)
         self.precision = options.get('precision', 0.0)
+        self.normalized = options.get('normalized', False)
+        self.levels = options.get('levels', 0)
+        self.margin = options.get('margin')
+        self.window = options.get('window')
+        self.confidence = options.get('confidence', 0.75)
+        self.matches = options.get('matches')
+        self.scales = options.get('scales')
+        self.scale = None
+        self.last = None
+        self.hits = 0
+        self.fallbacks = 0
 
     def __call__(self, inputs, context):
-        template = context.memory[self.roi]
-        (spotted, topleft, precision) = templatesearch(inputs.data, template)
+        template = self.template(context)
+        if self.matches != None:
+            return self.searchall(inputs, template)
+
+        index = self.searchwindow(inputs.data.shape, template.shape)
+        if index != None:
+            try:
+                spotted = _call((self, 'window'), self.search, inputs, template, index)
+                self.hits += 1
+                return spotted
+            except failure:
+                self.fallbacks += 1
+
+        return _call((self, 'scene'), self.search, inputs, template)
+
+    def search(self, inputs, template, index=None):
+        r'''Searches for the template within the given region of the scene
+            (or all of it, if index is None), returning the resulting percept.
+        '''
+        if index == None:
+            (data, spectrum) = (inputs.data, inputs.spectrum)
+        else:
+            (data, spectrum) = (inputs.data[index], None)
+
+        scale = None
+        resized = template
+        if self.scales != None:
+            scales = tuple(self.scales)
+            phase = tuple(a % 2 for (a, b) in self.bounds)
+            (scale, found) = templatesearch_scaled(data, template, scales, self.normalized, spectrum, phase)
+            resized = scalebanks(template, scales, phase)[scales.index(scale)]
+            if resized is None:
+                resized = template
+        else:
+            found = templatesearch(data, template, self.normalized, self.levels, spectrum)
+
+        (spotted, topleft, precision) = found
+        if index != None:
+            # Negated, so flat spots (whose score is undefined) are rejected
+            if not ncc(resized, spotted) >= self.confidence:
+                raise failure()
+
+            topleft = tuple(k.start + i for (k, i) in izip(index, topleft))
+
+        spotted = self.accept((spotted, topleft, precision), inputs)
+        self.last = topleft
+        self.scale = scale
+        return spotted
+
+    def searchall(self, inputs, template):
+        r'''Searches the whole scene for every match of the template, returning
+            the list of resulting percepts, or raising a failure if none is
+            found.
+        '''
+        data = inputs.data
+        found = templatesearch_all(data, template, self.precision, self.matches or None, inputs.spectrum)
+        if len(found) == 0:
+            raise failure()
+
+        spotted = []
+        for (topleft, score) in found:
+            topleft = tuple(int(i) for i in topleft)
+            index = tuple(slice(i, i + n) for (i, n) in izip(topleft, template.shape))
+            spotted.append(percept(data[index].astype(float), topleft, inputs))
+
+        self.last = spotted[0].offset
+        return spotted
+
+    def searchwindow(self, shape, size):
+        r'''Returns the slices delimiting the region of a scene of the given
+            shape to be searched first for a template of the given size, or None
+            if the whole scene is to be searched right away.
+        '''
+        if self.margin != None and self.last != None:
+            margin = self.margin
+            bounds = tuple((i - margin, i + n + margin) for (i, n) in izip(self.last, size))
+        elif self.window != None:
+            bounds = self.window
+        else:
+            return None
+
+        index = tuple(slice(max(0, a), min(m, b)) for ((a, b), m) in izip(bounds, shape))
+        if any(k.stop - k.start < n for (k, n) in izip(index, size)):
+            return None
+
+        return index
+
+    @property
+    def batchable(self):
+        r'''Whether this search can be batched together with others over the
+            same scene (see visualmap.survey).
+        '''
+        return (
+            self.levels == 0 and self.margin == None and self.window == None
+            and self.matches == None and self.scales == None
+        )
+
+    def template(self, context):
+        r'''Returns the search template from the given visual map.
+        '''
+        return context.template(self.bounds)
+
+    def accept(self, found, inputs):
+        r'''Turns the (spot, topleft, precision) results of a template search
+            into a percept, or raises a failure if the match isn't precise
+            enough.
+        '''
+        (spotted, topleft, precision) = found
         if precision < self.precision:
             print precision
             raise failure()
@@ -227,30 +682,21 @@ class what(object):
 
 
 class where(object):
+    r'''Integration operation: replaces a spotted percept by the contour
+        (among the named set of ROI's in the visual map) that covers most of
+        it. If no contour covers any part of it, the percept is returned as is.
+    '''
     def __init__(self, label):
         self.label = label
 
     def __call__(self, spotted, context):
         parent = spotted.parent
-        topleft = parent.topleft
         contours = context.rois[self.label]
+        if not isinstance(contours, roiset):
+            contours = roiset(contours)
 
         roi = tuple((i, i + n) for (i, n) in izip(spotted.offset, spotted.data.shape))
-
-        def inroi(i, r):
-            for ((a, n), x) in izip(r, i):
-                if not (a <= x < n):
-                    return False
-
-            return True
-
-        counts = ballot()
-        for i in product(*[range(*x) for x in roi]):
-            for c in contours:
-                if inroi(i, c):
-                    counts.vote(c)
-
-        roi = counts.winner()
+        roi = contours.elect(roi)
         if roi != None:
             return percept(parent.data[fancy_index(roi)], tuple(i[0] for i in roi), parent)
         else:
@@ -260,6 +706,108 @@ class where(object):
         return "where('%s')" % self.label
 
 
+class roiset(tuple):
+    r'''A set of Regions of Interest (ROI's), i.e. contours ((r0, rn), (c0,
+        cn)), compiled for fast lookup of the contour covering most of a region.
+
+        Unless contours overlap each other, the set is compiled into a label
+        raster, where each pixel holds the index of the contour covering it (or
+        -1 if none does): counting the contours covering a region then takes a
+        single bincount over the region's slice of the raster, however many
+        contours there are. Overlapping contours are instead checked against
+        the region one by one, in a single vectorized pass.
+    '''
+    def __new__(cls, contours, compiled=None):
+        return tuple.__new__(cls, contours)
+
+    def __init__(self, contours, compiled=None):
+        r'''Compiles a new ROI set out of a sequence of contours. A (raster,
+            origin) pair compiled beforehand (e.g. loaded from a bundle, see
+            skeye.bundle) can be given, in which case it's used as is.
+        '''
+        groups = []
+        keys = {}
+        for (j, contour) in enumerate(self):
+            key = str(contour)
+            if key not in keys:
+                keys[key] = len(groups)
+                groups.append([])
+
+            groups[keys[key]].append(j)
+
+        self.firsts = asarray([group[0] for group in groups], dtype=int)
+        self.lasts = asarray([group[-1] for group in groups], dtype=int)
+        self.counts = asarray([len(group) for group in groups], dtype=int)
+        self.bounds = asarray([self[j] for j in self.firsts], dtype=int).reshape((-1, 2, 2))
+        (self.raster, self.origin) = compiled if compiled != None else self.__rasterize()
+
+    def __rasterize(self):
+        bounds = self.bounds
+        n = len(bounds)
+        if n == 0:
+            return (None, None)
+
+        lower = maximum(bounds[:, None, :, 0], bounds[None, :, :, 0])
+        upper = minimum(bounds[:, None, :, 1], bounds[None, :, :, 1])
+        areas = clip(upper - lower, 0, None).prod(axis=-1)
+        areas[arange(n), arange(n)] = 0
+        if areas.any():
+            return (None, None)
+
+        origin = bounds[:, :, 0].min(axis=0)
+        shape = bounds[:, :, 1].max(axis=0) - origin
+        raster = empty(tuple(shape), dtype=int16 if n < 32767 else int32)
+        raster.fill(-1)
+        for (k, ((r0, rn), (c0, cn))) in enumerate(bounds - origin[:, None]):
+            raster[r0:rn, c0:cn] = k
+
+        return (raster, origin)
+
+    def votes(self, region):
+        r'''Returns, for each distinct contour in the set, the number of
+            pixels of the region it covers -- counted once for each time the
+            contour is repeated in the set.
+        '''
+        raster = self.raster
+        if raster is None:
+            areas = overlap(region, self.bounds)
+        else:
+            index = tuple(
+                slice(max(0, a - o), max(0, min(m, b - o)))
+                for ((a, b), o, m) in izip(region, self.origin, raster.shape)
+            )
+
+            labels = raster[index].ravel()
+            areas = bincount(labels + 1, minlength=len(self.bounds) + 1)[1:]
+
+        return areas * self.counts
+
+    def elect(self, region):
+        r'''Returns the contour that covers the largest area of the given
+            region, or None if none covers any of it.
+
+            Results are the same as if every pixel of the region voted for
+            every contour covering it (see skeye.ballot): identical contours
+            pool their votes, and ties go to the contour that first reached the
+            top count, scanning the region in row-major order.
+        '''
+        if len(self.bounds) == 0:
+            return None
+
+        votes = self.votes(region)
+        top = votes.max()
+        if top <= 0:
+            return None
+
+        tied = flatnonzero(votes == top)
+
+        # Last pixel voted for by each tied contour, in row-major order
+        corners = minimum(self.bounds[tied, :, 1], asarray(region)[:, 1]) - 1
+
+        order = lexsort((self.lasts[tied], corners[:, 1], corners[:, 0]))
+        return self[self.firsts[tied[order[0]]]]
+
+
 class look(what):
     def __init__(self, image, *roi):
         what.__init__(self, *roi)
@@ -271,11 +819,25 @@ class look(what):
 
 
 class locate(object):
+    r'''Searches for a labeled object, either in the given inputs or else in
+        frames polled from a source every delay seconds, until it's found. The
+        source can be the screen (the default), an image, or a frame source
+        (see skeye.sources); in the latter case, the search fails once the
+        source is exhausted. The source can also be a capture hub (see
+        skeye.sources.hub), whose frames are shared with other commands polling
+        it, and come already converted and transformed; each poll then waits
+        for a frame captured after it started.
+
+        While polling, frames identical to the last one in which the search
+        failed are skipped without searching them again. The counter 'skipped'
+        keeps track of how many frames were skipped this way.
+    '''
     def __init__(self, index, label, delay=0, source=Screenshot):
         self.delay = delay
         self.index = index
         self.label = label
         self.source = source
+        self.skipped = 0
 
     def __call__(self, inputs=None, context=None):
         sight = context.memory[self.index]
@@ -284,37 +846,222 @@ class locate(object):
         if inputs != None:
             return description(inputs, context=sight)
 
+        failed = None
         while True:
-            sleep(self.delay)
-            inputs = percept(bayer(self.source))
-            try:
-                return description(inputs, context=sight)
-            except failure:
-                pass
+            _call((self, 'sleep'), sleep, self.delay)
+            (found, failed) = _call((self, 'poll'), self.poll, description, sight, failed)
+            if found != None:
+                return found
+
+    def coroutine(self, inputs=None, context=None):
+        r'''Returns a coroutine running the search on a reactor loop. Waits
+            between frames suspend the coroutine instead of blocking, and frames
+            are grabbed and searched on the loop's worker threads.
+        '''
+        sight = context.memory[self.index]
+        description = sight.descriptors[self.label]
+
+        if inputs != None:
+            found = yield offload(description, inputs, context=sight)
+            raise result(found)
+
+        failed = None
+        while True:
+            yield wait(self.delay)
+            (found, failed) = yield offload(_call, (self, 'poll'), self.poll, description, sight, failed)
+            if found != None:
+                raise result(found)
+
+    def poll(self, description, sight, failed):
+        r'''Grabs a frame from the source and searches it, unless its
+            fingerprint matches that of the last failed frame. Returns the
+            percept found (or None) and the fingerprint of the last failed frame.
+        '''
+        inputs = _call((self, 'capture'), self.perceive)
+        current = fingerprint(inputs.data)
+        if current == failed:
+            self.skipped += 1
+            return (None, failed)
+
+        try:
+            return (_call((self, 'search'), description, inputs, context=sight), failed)
+        except failure:
+            return (None, current)
+
+    def perceive(self):
+        r'''Returns a percept of the next frame from the source.
+        '''
+        source = self.source
+        if isinstance(source, hub):
+            grabbed = source.fetch()
+            return percept(grabbed.data, spectrum=grabbed.spectrum)
+
+        return percept(bayer(source))
+
+    def __str__(self):
+        return 'locate(%r, %r)' % (self.index, self.label)
 
 
 class lookout(object):
-    def __init__(self, perceptor, index, *labels):
+    r'''Perceives a scene, then searches it for a number of labeled objects,
+        returning the list of percepts found.
+
+        If the 'workers' option is greater than 1, labels are searched for in
+        parallel by that many worker processes (see fanout()), which inherit
+        template spectra computed beforehand by the parent; otherwise they
+        are searched for all at once over a single scene transform (see
+        visualmap.survey).
+    '''
+    def __init__(self, perceptor, index, *labels, **options):
         self.perceptor = perceptor
         self.index = index
         self.labels = labels
+        self.workers = options.get('workers', 0)
 
     def __call__(self, context):
         perceptor = self.perceptor
         memory = context.memory[self.index]
         inputs = perceptor(context=memory)
-        return [memory(label, inputs) for label in self.labels]
+        if self.workers > 1:
+            memory.prepare(self.labels, inputs.data.shape)
+            tasks = [lambda scene, label=label: memory(label, scene) for label in self.labels]
+            return fanout(tasks, inputs, self.workers)
+
+        return memory.survey(self.labels, inputs)
 
 
 class zoomin(object):
-    def __init__(self, perceptor, *actions):
+    r'''Perceives a scene, then runs a sequence of actions over it, returning
+        the list of their outputs.
+
+        If the 'workers' option is greater than 1, actions are run in parallel
+        by that many worker processes (see fanout()). Actions with side effects
+        (e.g. clicks) then also happen in no particular order, so this should
+        only be enabled for independent searches.
+    '''
+    def __init__(self, perceptor, *actions, **options):
         self.perceptor = perceptor
         self.actions = actions
+        self.workers = options.get('workers', 0)
 
     def __call__(self, context):
         perceptor = self.perceptor
         inputs = perceptor(context=context)
-        return [action(inputs, context=context) for action in self.actions]
+        if self.workers > 1:
+            tasks = [lambda scene, action=action: action(scene, context=context) for action in self.actions]
+            return fanout(tasks, inputs, self.workers)
+
+        return [_call(action, action, inputs, context=context) for action in self.actions]
+
+
+# State inherited by fanout() worker processes
+_fanout_state = None
+
+
+def fanout(tasks, inputs, workers):
+    r'''Runs every task (a callable taking a single percept argument) over the
+        given inputs on a pool of worker processes, returning their outputs in
+        order. If any task fails, a failure is raised for the first one in
+        order, as if they had been run one after the other.
+
+        The scene's pixels are copied once into shared memory, which workers
+        inherit when the pool starts, instead of being pickled for every task.
+        Percepts returned by tasks are sent back without their ancestors, and
+        then reattached to the original inputs.
+
+        Workers inherit tasks (which are usually closures, and can't be
+        pickled) and cached spectra by being forked from the current process.
+        Where processes can't be forked (i.e. on Windows), tasks are instead
+        run one after the other in the current process.
+    '''
+    if platform.system() == 'Windows':
+        return [task(inputs) for task in tasks]
+
+    from ctypes import c_ubyte
+    from multiprocessing import Pool
+    from multiprocessing.sharedctypes import RawArray
+
+    data = inputs.data
+    buffer = RawArray(c_ubyte, data.nbytes)
+    state = (tasks, buffer, data.shape, data.dtype, inputs.offset, inputs.parent)
+    _frombuffer(buffer, data.shape, data.dtype)[...] = data
+
+    pool = Pool(min(workers, len(tasks)), _fanout_attach, (state,))
+    try:
+        outputs = pool.map(_fanout_run, range(len(tasks)))
+    finally:
+        pool.terminate()
+
+    results = []
+    for (failed, output) in outputs:
+        if failed:
+            raise failure(*output)
+
+        results.append(_reattach(output, inputs))
+
+    return results
+
+
+def _frombuffer(buffer, shape, dtype):
+    from numpy import frombuffer
+    return frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _fanout_attach(state):
+    global _fanout_state
+    (tasks, buffer, shape, dtype, offset, parent) = state
+    scene = percept(_frombuffer(buffer, shape, dtype), offset, parent)
+    _fanout_state = (tasks, scene)
+
+
+def _fanout_run(i):
+    (tasks, scene) = _fanout_state
+    try:
+        return (False, _detach(tasks[i](scene), scene))
+    except failure as e:
+        return (True, e.args)
+
+
+def _detach(output, scene):
+    r'''Replaces percepts descending from the scene by their lineage up to it,
+        as a list of (data, offset) pairs.
+    '''
+    if isinstance(output, (list, tuple)) and not isinstance(output, varargs):
+        return type(output)(_detach(item, scene) for item in output)
+
+    if not isinstance(output, percept):
+        return output
+
+    lineage = []
+    current = output
+    while current is not scene:
+        if current == None:
+            return output
+
+        lineage.append((current.data, current.offset))
+        current = current.parent
+
+    return _lineage(lineage)
+
+
+class _lineage(list):
+    pass
+
+
+def _reattach(output, inputs):
+    r'''Reverses _detach(), rebuilding percepts over the given inputs.
+    '''
+    if isinstance(output, _lineage):
+        spotted = inputs
+        for (data, offset) in reversed(output):
+            spotted = percept(data, offset, spotted)
+
+        return spotted
+
+    if isinstance(output, (list, tuple)) and not isinstance(output, varargs):
+        return type(output)(_reattach(item, inputs) for item in output)
+
+    return output
 
 
 class automate(object):
@@ -339,6 +1086,10 @@ class click(object):
 
 
 class mark(object):
+    r'''Draws the region of a percept over a source image, saving the result.
+        The source can be an image file path or a Bayer mosaic, which is then
+        demosaicked for display.
+    '''
     def __init__(self, source, saveas):
         self.source = source
         self.saveas = saveas
@@ -348,7 +1099,11 @@ class mark(object):
             return
 
         ((y0, y1), (x0, x1)) = perceived.region
-        image = open_image(self.source)
+        if isinstance(self.source, ndarray):
+            image = bayer.toimage(self.source)
+        else:
+            image = open_image(self.source)
+
         draw = Draw(image)
         draw.rectangle((x0, y0, x1, y1), outline=(255, 0, 0))
         image.save(self.saveas)
@@ -26,10 +26,12 @@ along with Skeye. If not, see <http://www.gnu.org/licenses/>.
 __version__ = '1'
 
 import platform
+from contextlib import contextmanager
 from os import system
-from time import sleep
+from re import split
+from subprocess import call
 
-from skeye import singleton
+from skeye import singleton, failure
 
 
 # Mouse click constants
@@ -43,6 +45,10 @@ class _desktop_windows(object):
         self.__client = Dispatch('AutoItX3.Control')
         self.__buttons = {Left: 'left', Right: 'right'}
 
+    @contextmanager
+    def batch(self):
+        yield
+
     def click(self, x, y, button=Left, delay=0):
         self.__client.MouseClick(self.__buttons[button], x, y, 1, 50)
 
@@ -57,23 +63,89 @@ class _desktop_windows(object):
 class _desktop_x11(object):
     r'''X11 desktop automator, wraps xdotool.
 
+        Each action runs as a single xdotool invocation, with its commands
+        chained on one command line and no shell in between. Actions run
+        within a batch() context are further chained together, and only run
+        when the context exits. Since xdotool's 'type' command takes up all
+        arguments after it, a chain is cut short after each text typed, so a
+        batch may still take more than one invocation. The xdotool binary can
+        be given explicitly, e.g. to run against a stub (see demo_desktop.py).
+
         http://www.semicomplete.com/projects/xdotool/xdotool
     '''
-    def __init__(self):
-        self.__buttons = {Left: 1, Right: 2}
+    def __init__(self, binary='xdotool'):
+        self.binary = binary
+        self.__buttons = {Left: 1, Right: 3}
+        self.__keys = {'\n': 'KP_Enter', '\t': 'Tab'}
+        self.__pending = None
+
+    @contextmanager
+    def batch(self):
+        r'''Chains all actions run within the context into as few xdotool
+            invocations as possible, run when the context exits -- unless it
+            exits with an exception, in which case nothing is run. Nested
+            contexts are merged into the outermost one.
+        '''
+        if self.__pending != None:
+            yield
+            return
+
+        self.__pending = [[]]
+        try:
+            yield
+            pending = self.__pending
+        finally:
+            self.__pending = None
+
+        for args in pending:
+            if len(args) > 0:
+                self.__execute(args)
 
     def click(self, x, y, button=Left, delay=100):
-        system('xdotool mousemove %d %d' % (x, y))
-        sleep(delay)
-        system('xdotool click %d' % self.__buttons[button])
+        r'''Moves the mouse cursor to the given coordinates, then clicks the
+            given button after a delay in milliseconds.
+        '''
+        self.__send('mousemove', x, y, 'sleep', delay / 1000.0, 'click', self.__buttons[button])
 
     def run(self, command):
         system(command)
 
-    def write(self, text):
-        keys = [c if c != '\n' else 'KP_Enter' for c in text]
-        command = 'xdotool key ' + ' '.join(keys)
-        system(command)
+    def write(self, text, delay=12):
+        r'''Types the given text, pausing for delay milliseconds between keys.
+            Line breaks and tabs are sent as the Enter (on the keypad) and Tab
+            keys.
+        '''
+        with self.batch():
+            keys = []
+            for segment in split('([\n\t])', text):
+                if segment in self.__keys:
+                    keys.append(self.__keys[segment])
+                elif len(segment) > 0:
+                    command = [] if len(keys) == 0 else ['key', '--delay', delay] + keys
+                    command += ['type', '--delay', delay]
+                    if segment.startswith('-'):
+                        command.append('--')
+
+                    self.__send(*(command + [segment]), last=True)
+                    keys = []
+
+            if len(keys) > 0:
+                self.__send('key', '--delay', delay, *keys)
+
+    def __send(self, *args, **options):
+        pending = self.__pending
+        if pending == None:
+            self.__execute(args)
+            return
+
+        pending[-1].extend(args)
+        if options.get('last', False):
+            pending.append([])
+
+    def __execute(self, args):
+        status = call([self.binary] + [str(arg) for arg in args])
+        if status != 0:
+            raise failure('%s exited with status %d' % (self.binary, status))
 
 
 @singleton
@@ -96,6 +168,18 @@ class desktop(object):
     def __init__(self):
         self.__client = None
 
+    def use(self, backend, *args, **options):
+        r'''Selects the automation backend, either by name ('x11' or 'windows')
+            or as an object implementing the same methods. Extra arguments are
+            passed on to named backends' constructors, e.g. the path to the
+            xdotool binary for 'x11'.
+        '''
+        backends = {'x11': _desktop_x11, 'windows': _desktop_windows}
+        if isinstance(backend, basestring):
+            backend = backends[backend](*args, **options)
+
+        self.__client = backend
+
     def __call__(self, command, *args, **opts):
         f = getattr(self.__getclient(), command)
         return f(*args, **opts)
@@ -0,0 +1,227 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+r'''A cooperative runtime for running many tasks (e.g. cogbots) at once.
+
+    Tasks are coroutines, written as generators that yield instructions to
+    the reactor loop:
+
+    * 'wait(seconds)' suspends the coroutine for the given time, without
+      blocking the loop;
+
+    * 'offload(function, *args, **kwargs)' runs a blocking or CPU-bound call
+      on the loop's worker threads, resuming the coroutine with its result
+      (or raising its exception inside the coroutine);
+
+    * yielding another coroutine runs it to completion, resuming the caller
+      with its result.
+
+    A coroutine produces its result by raising 'result(value)'. Any callable
+    can be turned into a coroutine with 'awaitable()': objects providing a
+    'coroutine()' method (such as the command classes in 'skeye.cogs') are
+    run natively, whereas plain callables are offloaded to a worker thread.
+'''
+
+__license__ = r'''
+Copyright (c) Helio Perroni Filho <xperroni@gmail.com>
+
+This file is part of Skeye.
+
+Skeye is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Skeye is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Skeye. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__version__ = '1'
+
+import sys
+from heapq import heappush, heappop
+from itertools import count
+from Queue import Queue, Empty
+from time import time
+from types import GeneratorType
+
+
+class result(Exception):
+    r'''Raised by a coroutine to produce its result.
+    '''
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class wait(object):
+    r'''Instruction to suspend a coroutine for the given time, in seconds.
+    '''
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class offload(object):
+    r'''Instruction to run a call on a worker thread, resuming the coroutine
+        once it's done.
+    '''
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+
+def awaitable(command, *args, **context):
+    r'''Returns a coroutine running the given command with the given arguments.
+        Commands providing a coroutine() method are run through it; any other
+        callable is run on a worker thread.
+    '''
+    coroutine = getattr(command, 'coroutine', None)
+    if coroutine != None:
+        return coroutine(*args, **context)
+
+    return _blocking(command, args, context)
+
+
+def _blocking(command, args, context):
+    value = yield offload(command, *args, **context)
+    raise result(value)
+
+
+class task(object):
+    r'''A coroutine scheduled on a reactor loop.
+    '''
+    def __init__(self, coroutine):
+        self.stack = [coroutine]
+        self.done = False
+        self.value = None
+        self.error = None
+
+
+class loop(object):
+    r'''Reactor loop, runs any number of coroutines concurrently on a single
+        thread, plus a pool of worker threads for offloaded calls.
+    '''
+    def __init__(self, workers=4):
+        r'''Creates a new loop, with the given number of worker threads.
+        '''
+        self.workers = workers
+        self.tasks = []
+        self.__timers = []
+        self.__sequence = count()
+        self.__completed = Queue()
+        self.__pool = None
+
+    def spawn(self, coroutine):
+        r'''Schedules a coroutine to run on the loop, returning its task.
+        '''
+        spawned = task(coroutine)
+        self.tasks.append(spawned)
+        self.__schedule(0, spawned, None, None)
+        return spawned
+
+    def run(self):
+        r'''Runs the loop until all tasks are done, returning the list of their
+            results, in the order they were spawned. If any task failed, the
+            exception of the first one to be spawned is re-raised.
+        '''
+        from multiprocessing.pool import ThreadPool
+
+        self.__pool = ThreadPool(self.workers)
+        try:
+            while not all(t.done for t in self.tasks):
+                self.__tick()
+        finally:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+        for t in self.tasks:
+            if t.error != None:
+                raise t.error[0], t.error[1], t.error[2]
+
+        return [t.value for t in self.tasks]
+
+    def __tick(self):
+        timers = self.__timers
+        timeout = max(0, timers[0][0] - time()) if len(timers) > 0 else None
+        try:
+            self.__step(*self.__completed.get(timeout=timeout))
+            while True:
+                self.__step(*self.__completed.get_nowait())
+        except Empty:
+            pass
+
+        now = time()
+        while len(timers) > 0 and timers[0][0] <= now:
+            (when, i, spawned, value, error) = heappop(timers)
+            self.__step(spawned, value, error)
+
+    def __schedule(self, delay, spawned, value, error):
+        heappush(self.__timers, (time() + delay, next(self.__sequence), spawned, value, error))
+
+    def __offload(self, spawned, instruction):
+        completed = self.__completed
+
+        def run():
+            try:
+                value = instruction.function(*instruction.args, **instruction.kwargs)
+                completed.put((spawned, value, None))
+            except:
+                completed.put((spawned, None, sys.exc_info()))
+
+        self.__pool.apply_async(run)
+
+    def __step(self, spawned, value, error):
+        stack = spawned.stack
+        while True:
+            coroutine = stack[-1]
+            try:
+                if error != None:
+                    instruction = coroutine.throw(*error)
+                else:
+                    instruction = coroutine.send(value)
+            except result as e:
+                (value, error) = (e.value, None)
+            except StopIteration:
+                (value, error) = (None, None)
+            except:
+                (value, error) = (None, sys.exc_info())
+            else:
+                (value, error) = (None, None)
+                if isinstance(instruction, wait):
+                    self.__schedule(instruction.seconds, spawned, None, None)
+                    return
+                elif isinstance(instruction, offload):
+                    self.__offload(spawned, instruction)
+                    return
+                elif isinstance(instruction, GeneratorType):
+                    stack.append(instruction)
+                else:
+                    value = instruction
+
+                continue
+
+            stack.pop()
+            if len(stack) == 0:
+                spawned.done = True
+                spawned.value = value
+                spawned.error = error
+                return
+
+
+def run(*coroutines, **options):
+    r'''Runs the given coroutines concurrently on a new loop until all of them
+        are done, returning the list of their results. Options are passed on
+        to the loop's constructor.
+    '''
+    reactor = loop(**options)
+    for coroutine in coroutines:
+        reactor.spawn(coroutine)
+
+    return reactor.run()
@@ -0,0 +1,240 @@
+#! /usr/bin/env python
+#coding=utf-8
+
+r'''Frame sources.
+
+    A frame source is any iterator over images -- numpy arrays, PIL images or
+    image file paths. Wherever an image is expected (e.g. snapshot(), bayer(),
+    or the 'source' argument of 'skeye.cogs.locate'), a frame source can be
+    given instead, in which case its next frame is used. This module provides
+    sources over image directories, video files and screen captures, as well
+    as 'prefetch', which decodes and converts frames ahead of time on a
+    background thread, and 'hub', which shares captured frames among several
+    consumers.
+'''
+
+__license__ = r'''
+Copyright (c) Helio Perroni Filho <xperroni@gmail.com>
+
+This file is part of Skeye.
+
+Skeye is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Skeye is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Skeye. If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__version__ = '1'
+
+import sys
+from glob import glob
+from os.path import join
+from Queue import Queue
+from threading import Condition, Thread
+from time import sleep, time
+
+from skeye import bayer, failure, fourier, snapshot
+
+
+def imagedir(path, pattern='*.png'):
+    r'''Iterates over the images in a directory whose names match the given
+        pattern, in alphabetical order.
+    '''
+    for name in sorted(glob(join(path, pattern))):
+        yield snapshot(name)
+
+
+def video(path):
+    r'''Iterates over the frames of a video file. Requires OpenCV.
+    '''
+    from cv2 import VideoCapture
+
+    capture = VideoCapture(path)
+    try:
+        while True:
+            (grabbed, frame) = capture.read()
+            if not grabbed:
+                break
+
+            yield frame[:, :, ::-1]
+    finally:
+        capture.release()
+
+
+def screencast(count=None, delay=0):
+    r'''Iterates over screenshots grabbed every delay seconds, either count
+        times or forever if count is None.
+    '''
+    i = 0
+    while count == None or i < count:
+        if i > 0:
+            sleep(delay)
+
+        yield snapshot()
+        i += 1
+
+
+class prefetch(object):
+    r'''Wraps a frame source, so that frames are read and converted (by
+        default, into Bayer mosaics) ahead of time on a background thread.
+
+        At most size converted frames are kept waiting in a queue, so the
+        background thread only runs ahead of the consumer by that much.
+        Exceptions raised while reading or converting frames are re-raised
+        to the consumer.
+    '''
+    def __init__(self, frames, size=4, convert=bayer):
+        r'''Creates a new prefetching source, and starts its background
+            thread.
+        '''
+        self.__queue = Queue(size)
+        self.__done = False
+
+        thread = Thread(target=self.__run, args=(iter(frames), convert))
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.__done:
+            raise StopIteration()
+
+        (frame, error) = self.__queue.get()
+        if error != None:
+            self.__done = True
+            raise error[0], error[1], error[2]
+
+        return frame
+
+    def __run(self, frames, convert):
+        queue = self.__queue
+        try:
+            for frame in frames:
+                queue.put((convert(frame), None))
+
+            raise StopIteration()
+        except:
+            queue.put((None, sys.exc_info()))
+
+
+class frame(object):
+    r'''A frame published by a capture hub: its sequence number, the time its
+        capture started, its Bayer mosaic, and the mosaic's transform (see
+        skeye.correlate).
+    '''
+    def __init__(self, sequence, captured, data, spectrum):
+        self.sequence = sequence
+        self.captured = captured
+        self.data = data
+        self.spectrum = spectrum
+
+
+class hub(object):
+    r'''Captures frames at a given rate (in frames per second) on a background
+        thread, and shares them among any number of consumers -- e.g. several
+        'skeye.cogs.locate' commands given the hub as their source.
+
+        Each frame is converted into a Bayer mosaic and transformed once, when
+        captured, rather than once per consumer. Consumers always wait for a
+        frame whose capture started after they asked for it, so they never get
+        a stale frame -- e.g. one showing the screen as it was before a click
+        -- nor the same frame twice. Frames are only captured while some
+        consumer is waiting for one.
+
+        Frames are taken from the screen by default, or else from the given
+        frame source; if the source is exhausted or raises an exception, so
+        does every consumer from then on.
+    '''
+    def __init__(self, rate=10, source=None):
+        r'''Creates a new capture hub, and starts its background thread.
+        '''
+        self.rate = rate
+        self.latest = None
+        self.__error = None
+        self.__waiting = []
+        self.__closed = False
+        self.__condition = Condition()
+
+        self.__thread = Thread(target=self.__run, args=(source,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def fetch(self):
+        r'''Returns the first frame whose capture starts after this call,
+            waiting for it.
+        '''
+        condition = self.__condition
+        with condition:
+            since = time()
+            self.__waiting.append(since)
+            condition.notify_all()
+            try:
+                while self.__error == None and not self.__fresh(since):
+                    # Waits with a timeout, so the wait can be interrupted
+                    condition.wait(1.0)
+            finally:
+                self.__waiting.remove(since)
+
+            # A frame captured in time is handed out even if the source
+            # failed (e.g. was exhausted) right after
+            if self.__fresh(since):
+                return self.latest
+
+            error = self.__error
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        r'''Stops capturing frames, waiting for the background thread to
+            finish. Consumers waiting for a frame, or asking for one
+            afterwards, get a failure.
+        '''
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+        self.__thread.join()
+
+    def __run(self, source):
+        condition = self.__condition
+        interval = 1.0 / self.rate
+        sequence = 0
+        tick = 0
+        try:
+            while True:
+                with condition:
+                    # Consumers already served by the latest frame don't
+                    # count, even if they haven't taken it yet
+                    while not self.__closed and all(self.__fresh(since) for since in self.__waiting):
+                        condition.wait(1.0)
+
+                    if self.__closed:
+                        raise failure('Capture hub closed')
+
+                tick = max(tick + interval, time())
+                sleep(max(0, tick - time()))
+
+                captured = time()
+                data = bayer(snapshot(source))
+                spectrum = fourier.rfft2(fourier.center(data))
+                sequence += 1
+
+                with condition:
+                    self.latest = frame(sequence, captured, data, spectrum)
+                    condition.notify_all()
+        except:
+            with condition:
+                self.__error = sys.exc_info()
+                condition.notify_all()
+
+    def __fresh(self, since):
+        return self.latest != None and self.latest.captured >= since